@@ -8,9 +8,13 @@ import traceback
 import cached_property
 from discord.ext import commands
 
+from nekosquared.shared import config
 from nekosquared.shared import traits
 
+from . import prefix
+from . import scheduler
 from . import shutdown
+from . import throttle
 
 
 # Sue me.
@@ -26,7 +30,8 @@ class Bot(commands.Bot, traits.Scribe):
         This accepts a dict with two sub-dictionaries:
         - ``auth`` - this must contain a ``token`` and a ``client_id`` member.
         - ``bot`` - this contains a group of kwargs to pass to the Discord.py
-            Bot constructor.
+            Bot constructor. This must contain a ``command_prefix``, which
+            is used as the default for any guild without custom prefixes.
     """
 
     def __init__(self,
@@ -34,7 +39,37 @@ class Bot(commands.Bot, traits.Scribe):
         """
         Initialise the bot using the given configuration.
         """
-        commands.Bot.__init__(self, **bot_config.pop('bot', {}))
+        bot_kwargs = bot_config.pop('bot', {})
+
+        try:
+            default_prefix = bot_kwargs.pop('command_prefix')
+        except KeyError:
+            raise SyntaxError('Ensure config has `bot\' section containing '
+                              'a `command_prefix\' field.')
+
+        # Per-guild prefixes are cached here. Anything storing custom prefixes
+        # should set the loader and call `set' or `invalidate' on changes.
+        self.prefix_resolver = prefix.PrefixResolver(default_prefix)
+
+        commands.Bot.__init__(self,
+                              command_prefix=self.prefix_resolver,
+                              **bot_kwargs)
+
+        self.add_listener(self.prefix_resolver.on_guild_remove)
+
+        # Background jobs. These are cancelled when their extension unloads.
+        self.scheduler = scheduler.Scheduler(
+            self.loop, extensions=lambda: self.extensions)
+
+        # Rate limits are optional. If there is no config, nothing is limited.
+        try:
+            throttle_cfg = config.get_config_data('throttle.yaml')()
+        except FileNotFoundError:
+            self.logger.warning('No throttle.yaml found. Commands will not be '
+                                'rate limited.')
+            throttle_cfg = None
+
+        self.throttle = throttle.Throttle(throttle_cfg)
 
         try:
             auth = bot_config['auth']
@@ -104,10 +139,48 @@ class Bot(commands.Bot, traits.Scribe):
             except BaseException:
                 traceback.print_exc()
 
+        try:
+            await self.scheduler.close()
+        except BaseException:
+            traceback.print_exc()
+
         await super().logout()
 
         self._logged_in = False
 
+    async def process_commands(self, message):
+        """
+        Discards anything that cannot possibly be a command before we go to
+        the effort of building a context for it. This runs for every message
+        we receive, so keep it cheap.
+        """
+        if message.author.bot:
+            return
+
+        prefixes = self.prefix_resolver.cached(
+            message.guild.id if message.guild else None)
+
+        if prefixes is None:
+            prefixes = await self.prefix_resolver.resolve(message)
+
+        if message.content.startswith(prefixes):
+            await super().process_commands(message)
+
+    async def invoke(self, ctx):
+        """
+        Applies rate limits and concurrency limits before invoking the
+        command. If the invocation is rejected, this goes to the command's,
+        cog's and global error handlers, the same as ``CommandOnCooldown``.
+        """
+        if ctx.command is None:
+            return await super().invoke(ctx)
+
+        try:
+            async with self.throttle.acquire(ctx):
+                await super().invoke(ctx)
+        except throttle.ThrottleError as ex:
+            await ctx.command.dispatch_error(ctx, ex)
+
     # noinspection PyBroadException
     def add_cog(self, cog):
         """
@@ -141,8 +214,12 @@ class Bot(commands.Bot, traits.Scribe):
         return self.extensions[name]
 
     def unload_extension(self, name):
-        """Logs and unloads the given extension."""
+        """
+        Logs and unloads the given extension. Any scheduled jobs that the
+        extension made are cancelled first.
+        """
         self.logger.info(f'Unloading extension {name!r}')
+        self.scheduler.cancel_owner(name)
         super().unload_extension(name)
 
     # noinspection PyBroadException
@@ -0,0 +1,203 @@
+"""
+Per-guild command prefix resolution.
+
+Every single message the bot can see ends up asking for the prefix, and the
+vast majority of those messages are not commands. Looking the prefix up in the
+database each time is not an option, so results are cached in memory per guild
+until they are explicitly invalidated, or for a short while if the lookup
+failed.
+"""
+import asyncio
+import time
+import typing
+
+from nekosquared.shared import traits
+
+
+__all__ = ('PrefixResolver',)
+
+
+# Coroutine taking a guild ID and returning the prefixes for that guild, or
+# None if the guild has not customised them.
+Loader = typing.Callable[[int], typing.Awaitable[typing.Optional[typing.Iterable[str]]]]
+
+
+def _normalise(prefixes) -> typing.Tuple[str, ...]:
+    """
+    Converts a string or iterable of strings into a tuple of unique prefixes,
+    longest first. Discord.py takes the first prefix that matches, so this
+    ensures that ``n2!`` is tried before ``n2``.
+    """
+    if isinstance(prefixes, str):
+        prefixes = (prefixes,)
+
+    prefixes = tuple(sorted(set(filter(bool, prefixes)), key=len, reverse=True))
+
+    if not prefixes:
+        raise ValueError('At least one non-empty prefix must be given.')
+    return prefixes
+
+
+class PrefixResolver(traits.Scribe):
+    """
+    Callable that can be passed as the ``command_prefix`` of a Discord.py bot.
+
+    Prefixes for each guild are fetched once using the ``loader`` coroutine
+    and then cached until ``invalidate`` is called. Guilds that the loader
+    returns ``None`` for use the default prefixes, and this is cached too, so
+    a guild without custom prefixes never causes a second lookup. Concurrent
+    misses for the same guild share a single call to the loader.
+
+    The resolved prefixes are always a tuple, so checking if a message might be
+    a command is a single ``str.startswith`` call.
+
+    If the loader fails, for example because the database is down, the guild
+    uses the default prefixes for ``retry_after`` seconds before we try the
+    loader again. Failures are logged at most once every ``retry_after``
+    seconds, however many guilds are affected.
+
+    :param default: the default prefix, or an iterable of default prefixes.
+    :param loader: optional coroutine function to look up the prefixes for a
+        guild ID. If unspecified, every guild uses the default prefixes.
+    :param retry_after: seconds to wait before retrying a failed lookup.
+        Defaults to 30.
+    """
+    def __init__(self, default, *, loader: Loader=None, retry_after=30.0):
+        self.default = _normalise(default)
+        self.loader = loader
+        self.retry_after = retry_after
+        self._cache: typing.Dict[int, typing.Tuple[str, ...]] = {}
+        self._pending: typing.Dict[int, asyncio.Future] = {}
+        # Timers to expire the defaults cached after a failed lookup.
+        self._retries: typing.Dict[int, asyncio.TimerHandle] = {}
+        self._last_warning = None
+        self._suppressed_warnings = 0
+
+    def cached(self, guild_id: typing.Optional[int]):
+        """
+        Returns the cached prefixes for the guild ID, or ``None`` if we
+        have not got them cached yet. Direct messages (a guild ID of ``None``)
+        always use the default prefixes.
+        """
+        if guild_id is None:
+            return self.default
+        return self._cache.get(guild_id)
+
+    async def resolve(self, message) -> typing.Tuple[str, ...]:
+        """
+        Gets the tuple of prefixes that apply to the given message.
+        """
+        guild = message.guild
+        if guild is None:
+            return self.default
+
+        # Avoid a coroutine switch on the hot path where possible.
+        prefixes = self._cache.get(guild.id)
+        if prefixes is not None:
+            return prefixes
+        return await self._load(guild.id)
+
+    async def _load(self, guild_id: int) -> typing.Tuple[str, ...]:
+        if self.loader is None:
+            self._cache[guild_id] = self.default
+            return self.default
+
+        pending = self._pending.get(guild_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_event_loop().create_future()
+        self._pending[guild_id] = future
+
+        try:
+            result = await self.loader(guild_id)
+            prefixes = self.default if result is None else _normalise(result)
+        except asyncio.CancelledError:
+            # This must come first, as it subclasses Exception before 3.8.
+            # Don't leave anyone waiting on us forever.
+            future.set_result(self.default)
+            raise
+        except Exception as ex:
+            # Fall back to the defaults rather than ignoring the guild, and
+            # cache them for a while so an outage does not mean a lookup for
+            # every message.
+            self._warn_failure(guild_id, ex)
+            if self._pending.get(guild_id) is future:
+                self._cache[guild_id] = self.default
+                self._retries[guild_id] = asyncio.get_event_loop().call_later(
+                    self.retry_after, self._expire_failure, guild_id)
+            future.set_result(self.default)
+            return self.default
+        except BaseException:
+            future.set_result(self.default)
+            raise
+        else:
+            # If we were invalidated whilst loading, the result may be stale.
+            if self._pending.get(guild_id) is future:
+                self._cache[guild_id] = prefixes
+            future.set_result(prefixes)
+            return prefixes
+        finally:
+            if self._pending.get(guild_id) is future:
+                del self._pending[guild_id]
+
+    def _expire_failure(self, guild_id):
+        if self._retries.pop(guild_id, None) is not None:
+            self._cache.pop(guild_id, None)
+
+    def _cancel_retry(self, guild_id):
+        handle = self._retries.pop(guild_id, None)
+        if handle is not None:
+            handle.cancel()
+
+    def _warn_failure(self, guild_id, ex):
+        now = time.monotonic()
+        if (self._last_warning is not None
+                and now - self._last_warning < self.retry_after):
+            self._suppressed_warnings += 1
+            return
+
+        suppressed = self._suppressed_warnings
+        self._last_warning = now
+        self._suppressed_warnings = 0
+        self.logger.warning(f'Failed to load prefixes for guild {guild_id}: '
+                            f'{ex!r} ({suppressed} similar failures '
+                            'suppressed)')
+
+    def set(self, guild_id: int, prefixes):
+        """
+        Updates the cached prefixes for a guild. This should be called
+        after changing the prefixes in the database, so that the change
+        takes effect immediately without another lookup.
+        """
+        self._cache[guild_id] = _normalise(prefixes)
+        self._pending.pop(guild_id, None)
+        self._cancel_retry(guild_id)
+
+    def invalidate(self, guild_id: int=None):
+        """
+        Removes the given guild from the cache, forcing the next message from
+        that guild to look the prefixes up again. If no guild ID is given, the
+        entire cache is cleared.
+        """
+        if guild_id is None:
+            self._cache.clear()
+            self._pending.clear()
+            for handle in self._retries.values():
+                handle.cancel()
+            self._retries.clear()
+        else:
+            self._cache.pop(guild_id, None)
+            self._pending.pop(guild_id, None)
+            self._cancel_retry(guild_id)
+
+    async def on_guild_remove(self, guild):
+        """Listener to drop guilds we are no longer in from the cache."""
+        self.invalidate(guild.id)
+
+    async def __call__(self, _bot, message) -> typing.List[str]:
+        """
+        Implements the ``command_prefix`` callable protocol that Discord.py
+        expects.
+        """
+        return list(await self.resolve(message))
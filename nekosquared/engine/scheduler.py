@@ -0,0 +1,431 @@
+"""
+Scheduler for delayed and periodic background jobs.
+
+Rather than each job being its own ``while True: await asyncio.sleep(...)``
+task, every job lives in a single heap ordered by when it is next due, and
+only one event loop timer is armed at a time, for whichever job is first. This
+keeps tens of thousands of pending reminders cheap, and means we know about
+every job so they can be cancelled when the extension that made them is
+unloaded.
+
+Periodic jobs are scheduled on a fixed grid from when they were first due, so
+they do not drift. If a job falls behind, because the loop was blocked or it
+was still running, the missed runs are either skipped (coalesced into one) or
+run back to back.
+"""
+import asyncio
+import functools
+import heapq
+import inspect
+import itertools
+import random
+import sys
+import time
+import typing
+
+from nekosquared.shared import traits
+
+
+__all__ = ('Job', 'Scheduler')
+
+
+# Timers can fire up to this early. Treat anything due this soon as due now.
+_RESOLUTION = time.get_clock_info('monotonic').resolution
+
+# Rebuild the heap once it has at least this many cancelled entries and they
+# make up over half of it.
+_MIN_COMPACT_SIZE = 1024
+
+
+def _extension_of(module, extensions) -> typing.Optional[str]:
+    """
+    Gets the name of the extension that the given module belongs to, or
+    ``None`` if it is not part of any of the given extensions.
+    """
+    while module:
+        if module in extensions:
+            return module
+        module = module.rpartition('.')[0]
+    return None
+
+
+class Job:
+    """
+    A job held by the scheduler. Do not make these directly; use the
+    ``call_*`` methods on ``Scheduler`` instead.
+    """
+    def __init__(self, scheduler, callback, args, *, interval, jitter,
+                 coalesce, max_concurrency, max_backlog, name, owner):
+        self.scheduler = scheduler
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.jitter = jitter
+        self.coalesce = coalesce
+        self.max_concurrency = max_concurrency
+        self.max_backlog = max_backlog
+        self.name = name or getattr(callback, '__qualname__', repr(callback))
+        self.owner = owner
+
+        # The time the job is next due, before any jitter is applied.
+        self.due = None
+        self.cancelled = False
+        self.tasks: typing.Set[asyncio.Task] = set()
+        # Runs that fell behind and are waiting for a free slot. Only used
+        # when coalesce is false.
+        self.backlog = 0
+        self._in_heap = False
+
+        self.runs = 0
+        self.failures = 0
+        # Runs dropped because max_concurrency was reached and either
+        # coalesce is set or the backlog is full.
+        self.skipped = 0
+        # Runs dropped because the job fell behind and coalesce is set.
+        self.coalesced = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_run = None
+
+    @property
+    def is_periodic(self):
+        return self.interval is not None
+
+    @property
+    def stats(self) -> dict:
+        """Run-time statistics for this job."""
+        return {
+            'name': self.name,
+            'owner': self.owner,
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'coalesced': self.coalesced,
+            'running': len(self.tasks),
+            'backlog': self.backlog,
+            'total_time': self.total_time,
+            'mean_time': self.total_time / self.runs if self.runs else 0.0,
+            'max_time': self.max_time,
+            'last_run': self.last_run,
+            'next_due': self.due if self._in_heap else None,
+        }
+
+    def cancel(self):
+        """Cancels the job and any runs of it that are in progress."""
+        self.scheduler.cancel(self)
+
+    def __repr__(self):
+        return (f'<Job name={self.name!r} owner={self.owner!r} '
+                f'interval={self.interval!r} cancelled={self.cancelled}>')
+
+
+class Scheduler(traits.Scribe):
+    """
+    Runs delayed and periodic jobs on the given event loop using a single
+    timer.
+
+    Callbacks may be coroutine functions or plain functions. Unless an
+    ``owner`` is given, jobs are owned by the code that scheduled them, not by
+    the callback, since callbacks are often library functions such as
+    ``channel.send``. We look back through the calling frames for the nearest
+    module belonging to one of the loaded ``extensions``, falling back to the
+    module that called us directly. ``cancel_owner`` cancels all jobs owned
+    by a module and its submodules.
+
+    :param loop: the event loop to use. Defaults to the current event loop.
+    :param extensions: optional callable returning the names of the loaded
+        extensions, such as ``lambda: bot.extensions``.
+    """
+    def __init__(self, loop=None, *, extensions=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.extensions = extensions
+        # Entries are (time due including jitter, sequence number, job).
+        self._heap: typing.List[tuple] = []
+        self._sequence = itertools.count()
+        self._jobs: typing.Set[Job] = set()
+        self._garbage = 0
+        self._timer: typing.Optional[asyncio.TimerHandle] = None
+        self._timer_when = None
+        # Set whilst we are firing, as we re-arm the timer afterwards anyway.
+        self._firing = False
+
+    def call_at(self, when, callback, *args, name=None, owner=None) -> Job:
+        """
+        Runs the callback once at the given event loop time.
+        """
+        job = Job(self, callback, args, interval=None, jitter=0.0,
+                  coalesce=True, max_concurrency=1, max_backlog=0, name=name,
+                  owner=owner if owner is not None else self._caller())
+        self._jobs.add(job)
+        self._push(job, when)
+        return job
+
+    def call_later(self, delay, callback, *args, name=None,
+                   owner=None) -> Job:
+        """
+        Runs the callback once after the given number of seconds.
+        """
+        return self.call_at(self.loop.time() + delay, callback, *args,
+                            name=name, owner=owner)
+
+    def call_every(self, interval, callback, *args, delay=None, jitter=0.0,
+                   coalesce=True, max_concurrency=1, max_backlog=None,
+                   name=None, owner=None) -> Job:
+        """
+        Runs the callback every ``interval`` seconds until cancelled.
+
+        :param interval: seconds between runs.
+        :param callback: the function or coroutine function to call.
+        :param args: positional arguments for the callback.
+        :param delay: seconds until the first run. Defaults to ``interval``.
+        :param jitter: each run is delayed by a random amount of up to this
+            many seconds, to stop many jobs firing at once. This does not
+            cause the job to drift.
+        :param coalesce: if true (the default), runs missed because the job
+            fell behind are dropped, and the job resumes at the next
+            interval. If false, missed runs are queued and started back to
+            back as soon as ``max_concurrency`` allows, up to
+            ``max_backlog`` of them.
+        :param max_concurrency: the most runs of this job that can be in
+            progress at once. If a run is due when this many are already in
+            progress, it is skipped, or queued if ``coalesce`` is false.
+            Defaults to 1.
+        :param max_backlog: the most runs that can be queued when
+            ``coalesce`` is false. Any more are skipped, so a job that is
+            always slower than its interval cannot fall further and further
+            behind. Defaults to ``max_concurrency``.
+        :param name: name to show in stats. Defaults to the callback name.
+        :param owner: module name that owns the job. Defaults to the
+            extension that scheduled it. See ``Scheduler``.
+        """
+        if interval <= 0:
+            raise ValueError('Interval must be positive.')
+        if max_concurrency < 1:
+            raise ValueError('Max concurrency must be at least 1.')
+        if max_backlog is None:
+            max_backlog = max_concurrency
+        elif max_backlog < 0:
+            raise ValueError('Max backlog cannot be negative.')
+
+        job = Job(self, callback, args, interval=interval, jitter=jitter,
+                  coalesce=coalesce, max_concurrency=max_concurrency,
+                  max_backlog=max_backlog,
+                  name=name,
+                  owner=owner if owner is not None else self._caller())
+        self._jobs.add(job)
+        self._push(job, self.loop.time() + (interval if delay is None
+                                            else delay))
+        return job
+
+    def cancel(self, job: Job):
+        """Cancels the job and any runs of it that are in progress."""
+        if job.cancelled:
+            return
+
+        job.cancelled = True
+        job.backlog = 0
+        self._jobs.discard(job)
+
+        if job._in_heap:
+            job._in_heap = False
+            self._garbage += 1
+            self._compact()
+
+        for task in job.tasks:
+            task.cancel()
+
+    def cancel_owner(self, owner: str) -> int:
+        """
+        Cancels all jobs owned by the given module or any of its submodules.
+        This returns the number of jobs cancelled.
+        """
+        submodule_prefix = owner + '.'
+        jobs = [
+            job for job in self._jobs
+            if job.owner == owner
+            or job.owner is not None and job.owner.startswith(submodule_prefix)
+        ]
+
+        for job in jobs:
+            self.cancel(job)
+
+        if jobs:
+            self.logger.info(f'Cancelled {len(jobs)} jobs owned by {owner!r}')
+        return len(jobs)
+
+    @property
+    def jobs(self) -> typing.FrozenSet[Job]:
+        """All jobs that have not finished or been cancelled."""
+        return frozenset(self._jobs)
+
+    def stats(self) -> dict:
+        """
+        Overall statistics. See ``Job.stats`` for statistics for a specific
+        job.
+        """
+        return {
+            'jobs': len(self._jobs),
+            'periodic': sum(job.is_periodic for job in self._jobs),
+            'pending': len(self._heap) - self._garbage,
+            'running': sum(len(job.tasks) for job in self._jobs),
+            'next_due': self._timer_when,
+        }
+
+    async def close(self):
+        """Cancels every job and waits for any in-progress runs to finish."""
+        tasks = [task for job in self._jobs for task in job.tasks]
+
+        for job in list(self._jobs):
+            self.cancel(job)
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = self._timer_when = None
+
+        self._heap.clear()
+        self._garbage = 0
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _caller(self) -> typing.Optional[str]:
+        """
+        Finds the module that scheduled a job. This is the nearest extension
+        on the stack if there is one, otherwise the first module outside of
+        this one.
+        """
+        extensions = self.extensions() if self.extensions else ()
+        frame = sys._getframe(1)
+        caller = None
+
+        while frame is not None:
+            module = frame.f_globals.get('__name__')
+            if module != __name__:
+                if caller is None:
+                    caller = module
+                    if not extensions:
+                        break
+
+                extension = _extension_of(module, extensions)
+                if extension is not None:
+                    return extension
+
+            frame = frame.f_back
+
+        return caller
+
+    def _push(self, job, due):
+        job.due = due
+        job._in_heap = True
+
+        when = due + random.uniform(0, job.jitter) if job.jitter else due
+        heapq.heappush(self._heap, (when, next(self._sequence), job))
+
+        if self._firing:
+            return
+        if self._timer_when is None or when < self._timer_when:
+            self._arm()
+
+    def _arm(self):
+        """Arms the timer for the first job in the heap."""
+        if self._timer is not None:
+            self._timer.cancel()
+
+        if self._heap:
+            self._timer_when = self._heap[0][0]
+            self._timer = self.loop.call_at(self._timer_when, self._fire)
+        else:
+            self._timer = self._timer_when = None
+
+    def _fire(self):
+        self._timer = self._timer_when = None
+        deadline = self.loop.time() + _RESOLUTION
+        self._firing = True
+
+        try:
+            while self._heap and self._heap[0][0] <= deadline:
+                _, _, job = heapq.heappop(self._heap)
+
+                if job.cancelled:
+                    self._garbage -= 1
+                    continue
+
+                job._in_heap = False
+                self._dispatch(job, deadline)
+        finally:
+            self._firing = False
+            self._arm()
+
+    def _dispatch(self, job, now):
+        runs, due = 1, None
+
+        if job.is_periodic:
+            due = job.due + job.interval
+            if due <= now:
+                missed = int((now - due) // job.interval) + 1
+                due += missed * job.interval
+                if job.coalesce:
+                    job.coalesced += missed
+                else:
+                    runs += missed
+
+        starting = max(0, min(runs, job.max_concurrency - len(job.tasks)))
+        for _ in range(starting):
+            self._start(job)
+
+        # Work out the rest arithmetically, as after a long stall there
+        # could be a great many of them.
+        remaining = runs - starting
+        if not job.coalesce:
+            queued = max(0, min(remaining, job.max_backlog - job.backlog))
+            job.backlog += queued
+            remaining -= queued
+        job.skipped += remaining
+
+        if due is not None:
+            self._push(job, due)
+
+    def _start(self, job):
+        task = self.loop.create_task(self._run(job))
+        job.tasks.add(task)
+        task.add_done_callback(functools.partial(self._on_run_done, job))
+
+    def _on_run_done(self, job, task):
+        job.tasks.discard(task)
+
+        # Start the next run that fell behind, if there is one.
+        if job.backlog and not job.cancelled:
+            job.backlog -= 1
+            self._start(job)
+
+    async def _run(self, job):
+        start = self.loop.time()
+        try:
+            result = job.callback(*job.args)
+            if inspect.isawaitable(result):
+                await result
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            job.failures += 1
+            self.logger.exception(f'Job {job.name!r} raised an exception')
+        finally:
+            elapsed = self.loop.time() - start
+            job.runs += 1
+            job.total_time += elapsed
+            job.max_time = max(job.max_time, elapsed)
+            job.last_run = start
+
+            if not job.is_periodic:
+                self._jobs.discard(job)
+
+    def _compact(self):
+        """Drops cancelled jobs from the heap once they dominate it."""
+        if (self._garbage < _MIN_COMPACT_SIZE
+                or self._garbage * 2 < len(self._heap)):
+            return
+
+        self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+        heapq.heapify(self._heap)
+        self._garbage = 0
+        self._arm()
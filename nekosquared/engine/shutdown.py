@@ -1,28 +1,46 @@
 """
 Holds callbacks for when we are about to shut the bot down. These can be
-either futures or
+futures, coroutines, coroutine functions, or any other callable taking no
+arguments. They are run in the order they were registered.
 
 Couldn't find another way of handling this sadly. Hooray for global variables.
 """
 import asyncio
-import functools
+import traceback
 
 
 _calls = asyncio.Queue()
 
 
 def on_shutdown(coro):
+    """
+    Registers a callback to run on shutdown. This returns the callback, so
+    can be used as a decorator.
+    """
+    if not (asyncio.isfuture(coro)
+            or asyncio.iscoroutine(coro)
+            or callable(coro)):
+        raise TypeError(f'Unexpected type {type(coro)!r}. Expected future, '
+                        'coroutine or callable.')
     _calls.put_nowait(coro)
+    return coro
 
 
+# noinspection PyBroadException
 async def terminate():
+    """
+    Runs each callback. A failing callback is logged, and does not prevent
+    the rest from running.
+    """
     while _calls.qsize():
         next_callable = await _calls.get()
-        if asyncio.isfuture(next_callable):
-            await next_callable
-        elif isinstance(next_callable,
-                        (functools.partial, functools.partialmethod)):
-            next_callable()
-        else:
-            raise TypeError(f'Unexpected type {type(next_callable)!r} '
-                            'Expected future, partial or partial method.')
+        try:
+            if asyncio.isfuture(next_callable) or asyncio.iscoroutine(
+                    next_callable):
+                await next_callable
+            elif asyncio.iscoroutinefunction(next_callable):
+                await next_callable()
+            else:
+                next_callable()
+        except Exception:
+            traceback.print_exc()
@@ -0,0 +1,413 @@
+"""
+Rate limiting and concurrency control for command invocations.
+
+Without this, one user or guild spamming an expensive command can fill up the
+shared thread and process pools and make the bot unresponsive for everyone
+else. Each invocation has to get past three things before it is allowed to
+run:
+
+1. Token buckets for the invoking user, the guild and the command itself. If
+    any bucket is empty, the invocation is rejected with ``RateLimited``.
+2. A per-command gate that bounds how many invocations run at once. Extra
+    invocations wait in a queue, and guilds take turns in that queue in
+    proportion to their weight, so one busy guild cannot starve the rest.
+3. If the queue is full, the invocation is rejected with ``Overloaded``
+    rather than piling up more work.
+
+The limits are read from ``throttle.yaml`` in the config directory. See
+``ex-config/throttle.yaml`` for an example.
+"""
+import asyncio
+import collections
+import time
+import typing
+
+from discord.ext import commands
+
+from nekosquared.shared import traits
+
+
+__all__ = ('ThrottleError', 'RateLimited', 'Overloaded', 'TokenBucket',
+           'Throttle')
+
+
+# Scopes that a token bucket can be keyed by.
+_SCOPES = ('user', 'guild', 'command')
+
+# Don't bother pruning buckets until we have at least this many.
+_MIN_PRUNE_SIZE = 1024
+
+
+class ThrottleError(commands.CommandError):
+    """Base for errors raised when an invocation is not allowed to run."""
+
+
+class RateLimited(ThrottleError):
+    """
+    Raised when a token bucket is empty.
+
+    :param scope: the scope of the bucket that was empty.
+    :param retry_after: seconds until the bucket has a token again.
+    """
+    def __init__(self, scope, retry_after):
+        super().__init__(f'Rate limited per {scope}. Try again in '
+                         f'{retry_after:.1f}s.')
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class Overloaded(ThrottleError):
+    """Raised when the queue for a command is full, so the call is shed."""
+    def __init__(self, command):
+        super().__init__(f'{command} is too busy right now. Try again later.')
+        self.command = command
+
+
+class TokenBucket:
+    """
+    Classic token bucket. Holds up to ``capacity`` tokens, and refills at
+    ``rate`` tokens every ``per`` seconds.
+
+    :param rate: tokens to add every ``per`` seconds.
+    :param per: refill period in seconds.
+    :param capacity: maximum number of tokens. Defaults to ``rate``.
+    """
+    __slots__ = ('fill_rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate, per, capacity=None, *, now=None):
+        self.fill_rate = rate / per
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.stamp = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        """Adds the tokens accumulated since the last refill."""
+        elapsed = now - self.stamp
+        if elapsed > 0:
+            self.tokens = min(self.capacity,
+                              self.tokens + elapsed * self.fill_rate)
+            self.stamp = now
+
+    def retry_after(self, now):
+        """
+        Refills the bucket and returns how long until a token is available,
+        or ``0`` if there is one available already.
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.fill_rate
+
+    def take(self):
+        """Removes a token. Call ``retry_after`` first to ensure we can."""
+        self.tokens -= 1
+
+    @property
+    def is_full(self):
+        return self.tokens >= self.capacity
+
+
+class _Gate:
+    """
+    Bounds the number of concurrent invocations of a command, queueing the
+    rest, up to ``queue_size`` (``None`` for no limit). Waiters are grouped
+    by guild, and guilds are served in a weighted round robin: a guild with
+    weight ``n`` gets up to ``n`` slots in a row before it has to give way to
+    the next guild with something queued.
+    """
+    def __init__(self, concurrency, queue_size, weights):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.weights = weights
+        self.active = 0
+        self.queued = 0
+        self._queues: typing.Dict[typing.Any, collections.deque] = (
+            collections.OrderedDict())
+        self._served = 0
+
+    @property
+    def is_queue_full(self):
+        return self.queue_size is not None and self.queued >= self.queue_size
+
+    @property
+    def would_shed(self):
+        """True if ``acquire`` would raise right now."""
+        has_slot = self.active < self.concurrency and not self.queued
+        return not has_slot and self.is_queue_full
+
+    async def acquire(self, guild_id):
+        """
+        Waits for a slot. Raises ``IndexError`` if the queue is full.
+        """
+        if self.active < self.concurrency and not self.queued:
+            self.active += 1
+            return
+
+        if self.is_queue_full:
+            raise IndexError('queue is full')
+
+        future = asyncio.get_event_loop().create_future()
+        self._queues.setdefault(guild_id, collections.deque()).append(future)
+        self.queued += 1
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We were given a slot just as we got cancelled.
+                self.release()
+            else:
+                self._discard(guild_id, future)
+            raise
+
+    def release(self):
+        """Gives up a slot, handing it to the next waiter if there is one."""
+        self.active -= 1
+
+        while self.active < self.concurrency and self.queued:
+            future = self._next()
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def _next(self):
+        guild_id, queue = next(iter(self._queues.items()))
+        future = queue.popleft()
+        self.queued -= 1
+        self._served += 1
+
+        if not queue:
+            del self._queues[guild_id]
+            self._served = 0
+        elif self._served >= self.weights.get(guild_id, 1):
+            self._queues.move_to_end(guild_id)
+            self._served = 0
+
+        return future
+
+    def _discard(self, guild_id, future):
+        queue = self._queues.get(guild_id)
+        if queue is None:
+            return
+
+        try:
+            queue.remove(future)
+        except ValueError:
+            return
+        else:
+            self.queued -= 1
+            if not queue:
+                if next(iter(self._queues)) == guild_id:
+                    self._served = 0
+                del self._queues[guild_id]
+
+
+class _Slot:
+    """Async context manager returned by ``Throttle.acquire``."""
+    __slots__ = ('throttle', 'ctx', 'gate', 'started')
+
+    def __init__(self, throttle, ctx):
+        self.throttle = throttle
+        self.ctx = ctx
+        self.gate = None
+        self.started = None
+
+    async def __aenter__(self):
+        self.gate = await self.throttle._enter(self.ctx)
+        self.started = time.monotonic()
+        return self
+
+    async def __aexit__(self, *_):
+        self.throttle._exit(self.ctx, self.gate, self.started)
+
+
+class Throttle(traits.Scribe):
+    """
+    Applies rate limits and concurrency limits to command invocations.
+
+    The config is a dict with the following optional members:
+
+    - ``defaults`` - limits that apply to any command not listed in
+        ``commands``. The token buckets are shared across all such commands,
+        but each command gets its own ``concurrency`` gate and queue.
+    - ``commands`` - a mapping of qualified command names to limits for that
+        specific command. These override the defaults entirely.
+    - ``guild_weights`` - a mapping of guild IDs to integer weights for
+        sharing queued capacity. Guilds not listed have a weight of 1.
+
+    Limits are a dict that may contain ``user``, ``guild`` and ``command``
+    buckets, each being a dict of ``rate``, ``per`` and optionally
+    ``capacity``, and ``concurrency`` and ``queue`` integers. Anything left out
+    is not limited, so ``concurrency`` without ``queue`` queues without bound,
+    and a ``queue`` of 0 sheds anything over the ``concurrency`` limit.
+
+    :param cfg: the config to use.
+    """
+    def __init__(self, cfg: dict=None):
+        cfg = cfg or {}
+        self.defaults: dict = cfg.get('defaults') or {}
+        self.command_limits: dict = cfg.get('commands') or {}
+        self.guild_weights: dict = {
+            int(k): max(1, int(v))
+            for k, v in (cfg.get('guild_weights') or {}).items()
+        }
+
+        self._buckets: typing.Dict[tuple, TokenBucket] = {}
+        self._prune_at = _MIN_PRUNE_SIZE
+        self._gates: typing.Dict[str, _Gate] = {}
+        self._counters: typing.Dict[str, collections.Counter] = (
+            collections.defaultdict(collections.Counter))
+        self._run_time: typing.Dict[str, float] = (
+            collections.defaultdict(float))
+
+    def limits_for(self, command_name) -> typing.Tuple[typing.Optional[str], dict]:
+        """
+        Gets the limits for the given command. This returns the name that
+        the token buckets are keyed by (``None`` for the defaults, so they
+        are shared) and the limits themselves.
+        """
+        limits = self.command_limits.get(command_name)
+        if limits is None:
+            return None, self.defaults
+        return command_name, limits
+
+    def acquire(self, ctx) -> _Slot:
+        """
+        Returns an async context manager that checks rate limits and waits
+        for a slot to run the invocation in. Raises ``RateLimited`` or
+        ``Overloaded`` if the invocation is not allowed to run.
+        """
+        return _Slot(self, ctx)
+
+    async def _enter(self, ctx):
+        name = ctx.command.qualified_name
+        key, limits = self.limits_for(name)
+        counters = self._counters[name]
+
+        guild_id = ctx.guild.id if ctx.guild else None
+        ids = {'user': ctx.author.id, 'guild': guild_id, 'command': None}
+
+        buckets = self._check_buckets(key, limits, ids, counters)
+
+        concurrency = limits.get('concurrency')
+        if not concurrency:
+            self._take_tokens(buckets)
+            counters['accepted'] += 1
+            return None
+
+        # Gates are always per command, even when using the defaults, so
+        # that one slow command cannot hold slots that others need.
+        gate = self._gates.get(name)
+        if gate is None:
+            gate = _Gate(concurrency, limits.get('queue'),
+                         self.guild_weights)
+            self._gates[name] = gate
+
+        # Shed before taking any tokens, so that being turned away does not
+        # count against the user's rate limits.
+        if gate.would_shed:
+            counters['shed'] += 1
+            raise Overloaded(name)
+
+        self._take_tokens(buckets)
+
+        if gate.active >= gate.concurrency or gate.queued:
+            counters['queued'] += 1
+
+        try:
+            await gate.acquire(guild_id)
+        except IndexError:
+            # Can't happen, as nothing can join the queue between the check
+            # above and here, but never let this escape.
+            counters['shed'] += 1
+            raise Overloaded(name) from None
+
+        counters['accepted'] += 1
+        return gate
+
+    def _exit(self, ctx, gate, started):
+        name = ctx.command.qualified_name
+        self._run_time[name] += time.monotonic() - started
+        self._counters[name]['completed'] += 1
+
+        if gate is not None:
+            gate.release()
+
+    def _check_buckets(self, key, limits, ids, counters) -> typing.List[TokenBucket]:
+        """
+        Ensures each applicable bucket has a token, raising ``RateLimited``
+        if not. This returns the buckets to pass to ``_take_tokens`` once we
+        are sure the invocation will go ahead.
+        """
+        now = time.monotonic()
+        buckets = []
+
+        for scope in _SCOPES:
+            spec = limits.get(scope)
+            if not spec or (scope == 'guild' and ids['guild'] is None):
+                continue
+
+            bucket_key = (key, scope, ids[scope])
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                bucket = TokenBucket(spec['rate'], spec['per'],
+                                     spec.get('capacity'), now=now)
+                self._buckets[bucket_key] = bucket
+
+            retry_after = bucket.retry_after(now)
+            if retry_after:
+                counters['rate_limited'] += 1
+                raise RateLimited(scope, retry_after)
+
+            buckets.append(bucket)
+
+        return buckets
+
+    def _take_tokens(self, buckets):
+        """Takes a token from each of the given buckets."""
+        for bucket in buckets:
+            bucket.take()
+
+        if len(self._buckets) > self._prune_at:
+            self._prune(time.monotonic())
+
+    def _prune(self, now):
+        """
+        Full buckets are indistinguishable from new ones, so they can be
+        dropped. This stops us holding a bucket for every user we have ever
+        seen. This is amortised by waiting for the number of buckets to double
+        between prunes.
+        """
+        stale = []
+        for bucket_key, bucket in self._buckets.items():
+            bucket.refill(now)
+            if bucket.is_full:
+                stale.append(bucket_key)
+
+        for bucket_key in stale:
+            del self._buckets[bucket_key]
+
+        self._prune_at = max(_MIN_PRUNE_SIZE, 2 * len(self._buckets))
+        self.logger.debug(f'Pruned {len(stale)} token buckets.')
+
+    def metrics(self) -> dict:
+        """
+        Returns a snapshot of the metrics collected so far. This is a dict
+        with ``commands``, mapping each command name to counters for
+        ``accepted``, ``queued``, ``shed``, ``rate_limited`` and ``completed``
+        invocations, and the total ``run_time`` spent in the command;
+        ``gates``, mapping each gate to the number of ``active`` and
+        ``queued`` invocations; and the number of live ``buckets``.
+        """
+        return {
+            'commands': {
+                name: {**counters, 'run_time': self._run_time[name]}
+                for name, counters in self._counters.items()
+            },
+            'gates': {
+                name: {'active': gate.active, 'queued': gate.queued,
+                       'concurrency': gate.concurrency}
+                for name, gate in self._gates.items()
+            },
+            'buckets': len(self._buckets),
+        }
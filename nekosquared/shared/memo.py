@@ -0,0 +1,289 @@
+"""
+Memoization for expensive, pure functions.
+
+Any cog can opt in with one line:
+
+    @memo.memoize(maxsize=64, ttl=300)
+    async def fetch_summary(url): ...
+
+The decorator works on plain functions, coroutine functions, and functions that
+should be run in the ``CpuBoundPool`` (pass ``cpu_bound=True``). Concurrent
+calls with the same arguments share a single computation rather than each
+doing the work themselves.
+"""
+import asyncio
+import collections
+import concurrent.futures as futures
+import functools
+import importlib
+import sys
+import threading
+import time
+import typing
+
+from nekosquared.shared import traits
+
+
+__all__ = ('CacheInfo', 'memoize')
+
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', 'hits misses evictions expired entries bytes')
+
+
+_MISSING = object()
+_KWD_MARK = object()
+
+
+def _call_by_name(module, qualname, args, kwargs):
+    """
+    Runs in the process pool. Functions are looked up by name here rather
+    than pickled, as the name may now refer to the memoized wrapper, which in
+    turn refers to the original through ``__wrapped__``.
+    """
+    fn = importlib.import_module(module)
+    for attr in qualname.split('.'):
+        fn = getattr(fn, attr)
+    fn = getattr(fn, '__wrapped__', fn)
+    return fn(*args, **kwargs)
+
+
+def _make_key(args, kwargs):
+    """Builds a hashable key from the call arguments."""
+    if kwargs:
+        return args + (_KWD_MARK,) + tuple(sorted(kwargs.items()))
+    return args
+
+
+class _Store:
+    """
+    LRU store with optional expiry and a bound on the approximate total size
+    of the values held. This is thread-safe.
+    """
+    def __init__(self, maxsize, maxbytes, ttl, sizeof):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.lock = threading.RLock()
+
+        # Key -> (value, expiry time or None, size in bytes)
+        self.entries: typing.Dict[typing.Any, tuple] = collections.OrderedDict()
+        self.bytes = 0
+
+        # Bumped on invalidation so that results computed before the
+        # invalidation are not stored after it.
+        self.generation = 0
+
+        # Key -> calls currently being computed, which new callers join. These
+        # are dropped on invalidation so that new callers start afresh.
+        self.in_flight: typing.Dict[typing.Any, typing.Any] = {}
+
+        self.hits = self.misses = self.evictions = self.expired = 0
+
+    def get(self, key):
+        """Returns the value for the key, or ``_MISSING``."""
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return _MISSING
+
+            value, expires_at, _ = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.expired += 1
+                self.misses += 1
+                return _MISSING
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation):
+        """
+        Stores the value, evicting the least recently used entries if we go
+        over either limit. Values computed in an older generation, and values
+        that would not fit at all, are not stored.
+        """
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+
+        with self.lock:
+            if generation != self.generation:
+                return
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (value, expires_at, size)
+            self.bytes += size
+
+            while (self.maxsize is not None
+                   and len(self.entries) > self.maxsize
+                   or self.maxbytes is not None
+                   and self.bytes > self.maxbytes):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            self.generation += 1
+            self.in_flight.pop(key, None)
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.in_flight.clear()
+            self.entries.clear()
+            self.bytes = 0
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.expired, len(self.entries), self.bytes)
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+
+
+def memoize(fn=None, *, maxsize: typing.Optional[int]=128,
+            maxbytes: int=None, ttl: float=None, sizeof=sys.getsizeof,
+            cpu_bound=False):
+    """
+    Decorates a function to cache its results. This can be used with or
+    without arguments.
+
+    The decorated function gains ``cache_info()``, which returns a
+    ``CacheInfo`` of statistics, ``cache_clear()``, which empties the cache,
+    and ``invalidate(*args, **kwargs)``, which removes the result for the
+    given arguments. Arguments must be hashable.
+
+    :param fn: the function to decorate.
+    :param maxsize: the maximum number of entries to hold, or ``None`` for
+        no limit. Defaults to 128.
+    :param maxbytes: the maximum approximate size of all cached values in
+        bytes, or ``None`` (the default) for no limit.
+    :param ttl: the number of seconds results are valid for, or ``None``
+        (the default) if they never expire.
+    :param sizeof: callable used to approximate the size of a value in bytes
+        when ``maxbytes`` is given. Defaults to ``sys.getsizeof``, which is
+        accurate for ``bytes`` and ``str`` but shallow for containers.
+    :param cpu_bound: if true, the function is run in the process pool used
+        by ``CpuBoundPool`` and the decorated function becomes a coroutine
+        function. The function must be defined at module level, and the
+        arguments and result must be picklable.
+    """
+    if fn is None:
+        return functools.partial(memoize, maxsize=maxsize, maxbytes=maxbytes,
+                                 ttl=ttl, sizeof=sizeof, cpu_bound=cpu_bound)
+
+    store = _Store(maxsize, maxbytes, ttl, sizeof)
+
+    if cpu_bound:
+        if '<' in fn.__qualname__:
+            raise TypeError(f'{fn.__qualname__} cannot be run in the process '
+                            'pool. Define it at module level.')
+        wrapper = _wrap_async(fn, store, cpu_bound=True)
+    elif asyncio.iscoroutinefunction(fn):
+        wrapper = _wrap_async(fn, store, cpu_bound=False)
+    else:
+        wrapper = _wrap_sync(fn, store)
+
+    wrapper.cache_info = store.info
+    wrapper.cache_clear = store.clear
+    wrapper.invalidate = lambda *a, **k: store.pop(_make_key(a, k))
+    return wrapper
+
+
+def _wrap_sync(fn, store):
+    # Calls currently being computed. Threads wait on these.
+    in_flight: typing.Dict[typing.Any, futures.Future] = store.in_flight
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = _make_key(args, kwargs)
+
+        with store.lock:
+            value = store.get(key)
+            if value is not _MISSING:
+                return value
+
+            pending = in_flight.get(key)
+            if pending is not None:
+                is_owner = False
+            else:
+                pending = in_flight[key] = futures.Future()
+                is_owner = True
+                generation = store.generation
+
+        if not is_owner:
+            return pending.result()
+
+        try:
+            value = fn(*args, **kwargs)
+        except BaseException as ex:
+            pending.set_exception(ex)
+            raise
+        else:
+            store.put(key, value, generation)
+            pending.set_result(value)
+            return value
+        finally:
+            with store.lock:
+                if in_flight.get(key) is pending:
+                    del in_flight[key]
+
+    return wrapper
+
+
+def _wrap_async(fn, store, *, cpu_bound):
+    # Calls currently being computed. Each runs in its own task, which every
+    # caller awaits through a shield. This way, cancelling one caller does not
+    # cancel the work that the others are waiting on.
+    in_flight: typing.Dict[typing.Any, asyncio.Task] = store.in_flight
+
+    async def compute(key, args, kwargs, generation):
+        if cpu_bound:
+            call = functools.partial(_call_by_name, fn.__module__,
+                                     fn.__qualname__, args, kwargs)
+            value = await asyncio.get_event_loop().run_in_executor(
+                traits._cpu_pool, call)
+        else:
+            value = await fn(*args, **kwargs)
+
+        store.put(key, value, generation)
+        return value
+
+    def on_done(key, task):
+        if in_flight.get(key) is task:
+            del in_flight[key]
+        # Mark any exception as retrieved so that asyncio does not complain
+        # if every caller was cancelled before it finished.
+        if not task.cancelled():
+            task.exception()
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        key = _make_key(args, kwargs)
+
+        value = store.get(key)
+        if value is not _MISSING:
+            return value
+
+        task = in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                compute(key, args, kwargs, store.generation))
+            task.add_done_callback(functools.partial(on_done, key))
+            in_flight[key] = task
+
+        return await asyncio.shield(task)
+
+    return wrapper
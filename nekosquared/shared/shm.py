@@ -0,0 +1,251 @@
+"""
+Passing large buffers to and from the process pool via shared memory.
+
+Submitting work to a ``ProcessPoolExecutor`` pickles the arguments, pushes them
+down a pipe, and unpickles them in the worker, then does the same again for
+the result. For multi-megabyte images and audio, those copies cost more than
+the work itself. Instead, large buffers are written once into a memory-mapped
+file in ``/dev/shm`` and only the path is sent to the worker, which maps the
+same memory.
+
+Segments are unlinked as soon as the call completes, or as soon as the worker
+finishes if the call was cancelled. Anything left behind by a crashed worker
+is named after this process, so it is removed by ``unlink_all`` when we shut
+down.
+"""
+import asyncio
+import atexit
+import functools
+import glob
+import mmap
+import os
+import tempfile
+import weakref
+
+
+__all__ = ('THRESHOLD', 'SharedBuffer', 'run', 'unlink_all')
+
+
+# Buffers smaller than this are cheaper to pickle than to share. Measured with
+# scratch/shm_bench.py, sharing starts to win at around 256KiB.
+THRESHOLD = 256 * 1024
+
+_SHM_DIR = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+_PREFIX = 'nekosquared-'
+
+_BUFFER_TYPES = (bytes, bytearray, memoryview)
+
+
+def _prefix(pid=None):
+    """Segments are prefixed with the PID of the process that owns them."""
+    return f'{_PREFIX}{pid or os.getpid()}-'
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class SharedBuffer:
+    """
+    A fixed-size buffer held in shared memory. Pickling this only sends the
+    path and size, and unpickling it maps the same memory in the receiving
+    process rather than copying it.
+
+    The owner of a buffer unlinks it when it is garbage collected. Buffers
+    received from another process are not owned, so must be unlinked
+    explicitly if the sender expects us to.
+
+    :param path: the path of the file backing the memory.
+    :param size: the size of the buffer in bytes.
+    :param owner: true if we should unlink the file when collected.
+    """
+    __slots__ = ('path', 'size', '_mmap', '_finalizer', '__weakref__')
+
+    def __init__(self, path, size, *, owner=False):
+        fd = os.open(path, os.O_RDWR)
+        try:
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.path = path
+        self.size = size
+        self._finalizer = weakref.finalize(self, _unlink, path) if owner else None
+
+    @classmethod
+    def create(cls, data, *, prefix=None, owner=True):
+        """
+        Makes a new shared buffer holding a copy of the given data.
+
+        :param data: any object supporting the buffer protocol.
+        :param prefix: the file name prefix. Defaults to one naming this
+            process.
+        :param owner: true if we should unlink the file when collected.
+        """
+        data = memoryview(data)
+        if not data.c_contiguous:
+            # Strided views can't be cast, so take a contiguous copy.
+            data = memoryview(data.tobytes())
+        data = data.cast('B')
+        fd, path = tempfile.mkstemp(prefix=prefix or _prefix(), dir=_SHM_DIR)
+        try:
+            os.ftruncate(fd, data.nbytes)
+        except BaseException:
+            os.close(fd)
+            _unlink(path)
+            raise
+        else:
+            os.close(fd)
+
+        buffer = cls(path, data.nbytes, owner=owner)
+        buffer._mmap[:] = data
+        return buffer
+
+    @property
+    def view(self) -> memoryview:
+        """A memoryview of the shared memory. This does not copy anything."""
+        return memoryview(self._mmap)
+
+    def tobytes(self) -> bytes:
+        """Copies the buffer into a new bytes object."""
+        return self._mmap[:]
+
+    def __len__(self):
+        return self.size
+
+    def __reduce__(self):
+        return type(self), (self.path, self.size)
+
+    def close(self):
+        """
+        Unmaps the memory in this process. If a memoryview of it is still
+        alive, the memory is unmapped when that is collected instead.
+        """
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    def unlink(self):
+        """
+        Closes the buffer and removes the backing file. Other processes that
+        have it mapped can keep using it until they close it.
+        """
+        self.close()
+        if self._finalizer is not None:
+            self._finalizer()
+        else:
+            _unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.unlink()
+
+
+def unlink_all(pid=None):
+    """
+    Removes every segment left behind by the given process, defaulting to
+    this one.
+    """
+    pattern = os.path.join(_SHM_DIR or tempfile.gettempdir(), _prefix(pid))
+    for path in glob.glob(glob.escape(pattern) + '*'):
+        _unlink(path)
+
+
+# The pool shutdown registers this with the engine too, but make sure we tidy
+# up even if we never get that far.
+atexit.register(unlink_all, os.getpid())
+
+
+def _share(value, owned):
+    if isinstance(value, _BUFFER_TYPES) and memoryview(value).nbytes >= THRESHOLD:
+        buffer = SharedBuffer.create(value)
+        owned.append(buffer)
+        return buffer
+    return value
+
+
+def _unwrap(value, attached):
+    if isinstance(value, SharedBuffer):
+        attached.append(value)
+        return value.view
+    return value
+
+
+def _call_in_worker(fn, prefix, args, kwargs):
+    """
+    Runs in the worker process. Buffers are passed to ``fn`` as memoryviews
+    of the shared memory, and a large result is returned in a new segment
+    which the caller is responsible for unlinking.
+    """
+    attached = []
+    try:
+        args = [_unwrap(arg, attached) for arg in args]
+        kwargs = {k: _unwrap(v, attached) for k, v in kwargs.items()}
+
+        result = fn(*args, **kwargs)
+
+        if isinstance(result, _BUFFER_TYPES):
+            if memoryview(result).nbytes >= THRESHOLD:
+                result = SharedBuffer.create(result, prefix=prefix, owner=False)
+                result.close()
+            elif isinstance(result, memoryview):
+                # Can't pickle these.
+                result = result.tobytes()
+
+        return result
+    finally:
+        for buffer in attached:
+            buffer.close()
+
+
+def _unlink_result(future):
+    """Unlinks the result of a call if it came back in shared memory."""
+    if future.cancelled() or future.exception() is not None:
+        return
+
+    result = future.result()
+    if isinstance(result, SharedBuffer):
+        result.unlink()
+
+
+async def run(executor, fn, *args, **kwargs):
+    """
+    Runs ``fn`` in the given process pool, passing any ``bytes``,
+    ``bytearray`` or ``memoryview`` arguments of at least ``THRESHOLD`` bytes
+    through shared memory. The function receives these as ``memoryview``
+    objects. If it returns a large buffer, that is passed back through
+    shared memory too, and we return it as ``bytes``.
+
+    ``fn`` must be picklable, so should be defined at module level.
+    """
+    owned = []
+    try:
+        args = [_share(arg, owned) for arg in args]
+        kwargs = {k: _share(v, owned) for k, v in kwargs.items()}
+
+        call = functools.partial(_call_in_worker, fn, _prefix(), args, kwargs)
+        future = executor.submit(call)
+
+        try:
+            result = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The worker may still be running, and will hand back a segment
+            # that nobody is waiting for. Tidy it up when it arrives.
+            future.add_done_callback(_unlink_result)
+            raise
+
+        if isinstance(result, SharedBuffer):
+            try:
+                return result.tobytes()
+            finally:
+                result.unlink()
+        return result
+    finally:
+        for buffer in owned:
+            buffer.unlink()
@@ -3,6 +3,7 @@ Various thread and process pool templates.
 """
 import asyncio
 import concurrent.futures as futures
+import functools
 import logging
 import os
 
@@ -12,6 +13,7 @@ import asyncpg
 
 from nekosquared.engine import shutdown
 from nekosquared.shared import config
+from nekosquared.shared import shm
 
 
 __all__ = ('Scribe', 'CpuBoundPool', 'IoBoundPool', 'FsPool',
@@ -73,11 +75,16 @@ del _processes, _threads, _magic_number
 async def __on_shutdown():
     loop = asyncio.get_event_loop()
     await asyncio.gather(
-        loop.call_soon_threadsafe(_cpu_pool.shutdown(True)),
-        loop.call_soon_threadsafe(_io_pool.shutdown(True))
+        loop.run_in_executor(None, functools.partial(_cpu_pool.shutdown, True)),
+        loop.run_in_executor(None, functools.partial(_io_pool.shutdown, True))
     )
 
 
+# Registered after the pools so that workers cannot leave anything behind
+# once this runs.
+shutdown.on_shutdown(shm.unlink_all)
+
+
 class CpuBoundPool:
     """
     Trait that implements a process pool execution service for CPU-bound work.
@@ -91,6 +98,15 @@ class CpuBoundPool:
     def cpu_pool(self) -> futures.Executor:
         return _cpu_pool
 
+    @staticmethod
+    async def run_in_cpu_pool_shared(fn, *args, **kwargs):
+        """
+        Runs ``fn`` in the process pool, passing large ``bytes``-like
+        arguments and results through shared memory rather than pickling
+        them. Use this for image and audio buffers. See ``shm.run``.
+        """
+        return await shm.run(_cpu_pool, fn, *args, **kwargs)
+
 
 class IoBoundPool:
     """
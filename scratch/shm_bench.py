@@ -0,0 +1,62 @@
+#!/usr/bin/env python3.6
+"""
+Compares passing buffers to the process pool by pickling them against
+passing them through shared memory. Run from the repository root:
+
+    python3.6 -m scratch.shm_bench
+"""
+import asyncio
+import concurrent.futures as futures
+import time
+import zlib
+
+from nekosquared.shared import shm
+
+
+SIZES = (16 * 1024, 64 * 1024, 128 * 1024, 256 * 1024, 512 * 1024,
+         1024 ** 2, 4 * 1024 ** 2, 32 * 1024 ** 2)
+REPEATS = 50
+
+
+def checksum(data):
+    """Only sends the buffer one way."""
+    return zlib.crc32(data)
+
+
+def copy(data):
+    """Sends a buffer of the same size back."""
+    return bytearray(data)
+
+
+async def bench(pool, fn, data, shared):
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        if shared:
+            await shm.run(pool, fn, data)
+        else:
+            await loop.run_in_executor(pool, fn, data)
+    return (time.perf_counter() - start) / REPEATS * 1000
+
+
+async def main():
+    # Share everything so small sizes are measured too. This is set before
+    # the worker is forked so that it sees it as well.
+    shm.THRESHOLD = 1
+
+    with futures.ProcessPoolExecutor(1) as pool:
+        # Warm the worker up.
+        await asyncio.get_event_loop().run_in_executor(pool, checksum, b'')
+
+        print(f'{"function":>10} {"size":>10} {"pickled":>12} {"shared":>12}')
+        for fn in (checksum, copy):
+            for size in SIZES:
+                data = bytes(size)
+                pickled = await bench(pool, fn, data, False)
+                shared = await bench(pool, fn, data, True)
+                print(f'{fn.__name__:>10} {size // 1024:>8}KB '
+                      f'{pickled:>10.2f}ms {shared:>10.2f}ms')
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())